@@ -1,13 +1,17 @@
 # Import python stdlib modules
+import asyncio
 import datetime
 import os
 import logging
 import json
+import signal
+import sys
+import traceback
 from time import time
 
 # Import python modules
 import discord
-from discord.ext import commands, menus
+from discord.ext import commands, menus, tasks
 
 
 """
@@ -26,6 +30,21 @@ Date: 03-21-2021
 """
 
 ENV_TOKEN = 'BASCOBOTTOKEN'
+# The path of the health check file, shared with the Dockerfile's HEALTHCHECK.
+ENV_HEALTH = 'BASCOBOTHEALTH'
+
+# Process exit statuses, so that orchestrators can tell why the bot stopped.
+EXIT_OK = 0
+EXIT_LOGIN_FAILURE = 1
+EXIT_DRAIN_TIMEOUT = 2
+EXIT_PRIVILEGED_INTENTS = 3
+
+# How often (in seconds) the health check file is refreshed while the bot is connected.
+# The Dockerfile's HEALTHCHECK treats a file older than two minutes as unhealthy.
+HEALTH_INTERVAL = 30
+
+# How long (in seconds) commands cancelled at the shutdown deadline get to run their cleanup and replies.
+CANCEL_TIMEOUT = 2
 
 
 class Const(object):
@@ -77,9 +96,185 @@ def get_prefix(bot, message):
         return '!'
 
 
+class CommandTimedOut(commands.CommandError):
+    """
+    Raised (through `on_command_error`) when a command runs longer than its configured timeout.
+    """
+    pass
+
+
+class CommandSlots(object):
+    """
+    The execution slots of a single command: how many invocations may run at once, how many more may wait for a
+    free slot, and how long each one may run.
+    """
+
+    def __init__(self, concurrency, queue, timeout):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_queued = queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.queued = 0
+
+
+class Dispatcher(object):
+    """
+    Limits how many invocations of each command run at once, queueing (up to a limit) those over it,
+    and enforces a timeout on each invocation. Limits are read from the "dispatch" section of the config.
+
+    NOTE: A timeout can only cancel a command while it is awaiting. Blocking calls, such as `reload_extension`,
+    run to completion before the timeout is noticed.
+    """
+
+    def __init__(self, settings):
+        self.default = settings.get('default', {})
+        self.overrides = settings.get('commands', {})
+        # {qualified command name: CommandSlots}, created on first use.
+        self.slots = {}
+
+    def get_slots(self, name):
+        """
+        Returns the execution slots of a command, creating them from the config on first use.
+
+        :param name: The qualified name of the command.
+        :return: The CommandSlots of the command.
+        """
+        if name not in self.slots:
+            limits = {'concurrency': 4, 'queue': 16, 'timeout': 30}
+            limits.update(self.default)
+            limits.update(self.overrides.get(name, {}))
+            self.slots[name] = CommandSlots(limits['concurrency'], limits['queue'], limits['timeout'])
+        return self.slots[name]
+
+    @staticmethod
+    def resolve(ctx):
+        """
+        Finds the command that will actually be invoked, following subcommands of groups, without consuming the
+        message's arguments.
+
+        :param ctx: The context of the command execution.
+        :return: The command (or subcommand) that will be invoked.
+        """
+        command = ctx.command
+        index, previous = ctx.view.index, ctx.view.previous
+        while isinstance(command, commands.Group):
+            ctx.view.skip_ws()
+            subcommand = command.get_command(ctx.view.get_word())
+            if subcommand is None:
+                break
+            command = subcommand
+        ctx.view.index, ctx.view.previous = index, previous
+        return command
+
+    @staticmethod
+    async def can_run(ctx, command):
+        """
+        Runs the checks of a command and of the groups it belongs to, without raising their errors.
+
+        :param ctx: The context of the command execution.
+        :param command: The command (or subcommand) that will be invoked.
+        :return: True if every check passed.
+        """
+        try:
+            for each_command in [*reversed(command.parents), command]:
+                if not await each_command.can_run(ctx):
+                    return False
+        except commands.CommandError:
+            return False
+        return True
+
+    async def dispatch(self, bot, ctx):
+        """
+        Invokes a command once one of its slots is free, replying with an error if its queue is full
+        or if it runs past its timeout.
+
+        :param bot: The instance of the Discord Client.
+        :param ctx: The context of the command execution.
+        """
+        if ctx.command is None:
+            # Let the bot raise CommandNotFound as usual.
+            return await bot.invoke(ctx)
+
+        # Tracked for the whole dispatch, so that shutdown also drains the replies sent from here.
+        bot.inflight.add(asyncio.current_task())
+        try:
+            await self.run(bot, ctx)
+        finally:
+            bot.inflight.discard(asyncio.current_task())
+
+    async def run(self, bot, ctx):
+        """
+        Waits for a free slot of the command, then invokes it with its timeout.
+
+        :param bot: The instance of the Discord Client.
+        :param ctx: The context of the command execution.
+        """
+        if bot.shutting_down:
+            return await ctx.send('The bot is shutting down, please try again later.')
+
+        command = self.resolve(ctx)
+        # Checked before taking a slot, so that users who may not run a command can't fill its queue.
+        if not await self.can_run(ctx, command):
+            # The invocation fails the same checks, and reports the error as usual.
+            return await bot.invoke(ctx)
+
+        name = command.qualified_name
+        slots = self.get_slots(name)
+
+        if slots.semaphore.locked() and slots.queued >= slots.max_queued:
+            return await ctx.send(f'`{name}` is busy right now, please try again later.')
+
+        slots.queued += 1
+        try:
+            await slots.semaphore.acquire()
+        finally:
+            slots.queued -= 1
+
+        if bot.shutting_down:
+            # The bot began shutting down while this command was queued.
+            slots.semaphore.release()
+            return await ctx.send('The bot is shutting down, please try again later.')
+
+        slots.in_flight += 1
+        task = asyncio.ensure_future(bot.invoke(ctx))
+        try:
+            # Whether the command timed out is decided by whether it finished in time, not by how it ended:
+            # discord.py swallows a cancellation inside the command's callback, so a cancelled command returns normally.
+            done, _ = await asyncio.wait({task}, timeout=slots.timeout)
+            if done:
+                task.result()
+            else:
+                task.cancel()
+                await asyncio.wait({task})
+                await ctx.command.dispatch_error(
+                    ctx, CommandTimedOut(f'{name} timed out after {slots.timeout} seconds.'))
+                await ctx.send(f'`{name}` took too long to respond and was cancelled.')
+        finally:
+            if not task.done():
+                task.cancel()
+            slots.in_flight -= 1
+            slots.semaphore.release()
+
+
+# How guild members are fetched, see `request_chunk`:
+#   "startup" - every guild is chunked when the bot connects.
+#   "lazy"    - a guild is chunked in the background the first time a role command is used in it.
+#   "none"    - guilds are never chunked, members are cached as they are seen.
+CHUNK_STRATEGIES = ('startup', 'lazy', 'none')
+chunking = config.get('chunking', {})
+chunk_strategy = chunking.get('strategy', 'none')
+if chunk_strategy not in CHUNK_STRATEGIES:
+    raise Exception(
+        f'ERROR: unknown chunking strategy "{chunk_strategy}", expected one of: {", ".join(CHUNK_STRATEGIES)}')
+
+# Chunking requires the (privileged) members intent.
+intents = discord.Intents.default()
+intents.members = chunk_strategy != 'none'
+
 # Instantiate the bot to use commands prefix from the config file
 bot = commands.Bot(
-    command_prefix=get_prefix, case_insensitive=True)
+    command_prefix=get_prefix, case_insensitive=True,
+    intents=intents, chunk_guilds_at_startup=chunk_strategy == 'startup')
 
 # Save the loaded config to the bot instance, so that it
 # can be accessed in other Cogs later.
@@ -91,11 +286,171 @@ bot.remove_command('help')
 # Load the bot's extensions here
 exts = [
     'cogs.botty',
-    'cogs.help'
+    'cogs.help',
+    'cogs.stats'
 ]
 for ext in exts:
     bot.load_extension(ext)
 
+# The tasks of commands that are currently being invoked, so they can be drained on shutdown.
+bot.inflight = set()
+bot.shutting_down = False
+bot.exit_status = EXIT_OK
+# Whether the gateway connection is currently up, see `on_ready`, `on_resumed`, and `on_disconnect`.
+bot.connected = False
+
+# Pending guild chunk requests by guild id, and the limit on how many may run at once across all guilds.
+chunk_requests = {}
+chunk_limiter = asyncio.Semaphore(chunking.get('max_concurrent', 2))
+
+
+async def chunk_guild(guild):
+    """
+    Requests every member of a guild from Discord, waiting for a free slot if too many guilds are being chunked.
+    The request is given up after the configured timeout, as discord.py waits forever for a lost chunk response;
+    the guild's members are then only cached as they are seen.
+
+    :param guild: The guild to chunk.
+    """
+    async with chunk_limiter:
+        if guild.chunked:
+            return
+        try:
+            await asyncio.wait_for(guild.chunk(cache=True), timeout=chunking.get('timeout', 60))
+        except asyncio.TimeoutError:
+            print(f'Timed out chunking guild {guild.name} (ID: {guild.id}), it will be retried on the next role command.')
+
+
+def request_chunk(guild):
+    """
+    With the "lazy" strategy, starts chunking a guild in the background the first time a role command is used in it.
+    Role commands never wait for it: discord.py keeps each member's role ids in a sorted array, and refreshes the
+    author's from every message, so role membership checks never need an API call.
+
+    :param guild: The guild the role command was used in.
+    """
+    if chunk_strategy != 'lazy' or guild.chunked or guild.id in chunk_requests:
+        return
+
+    task = chunk_requests[guild.id] = asyncio.ensure_future(chunk_guild(guild))
+    task.add_done_callback(lambda _: chunk_requests.pop(guild.id, None))
+
+
+# Available to cogs as `self.bot.request_chunk`.
+bot.request_chunk = request_chunk
+
+# Every command is invoked through the dispatcher, see `on_message`.
+bot.dispatcher = Dispatcher(config.get('dispatch', {}))
+
+
+def health_file():
+    """
+    Returns the path of the health check file, which is kept fresh only while the bot is connected to Discord.
+
+    :return: The absolute path to the health check file.
+    """
+    return os.path.abspath(os.getenv(ENV_HEALTH, './.health'))
+
+
+def set_healthy(healthy):
+    """
+    Creates or removes the health check file used by container orchestrators.
+
+    :param healthy: Whether the bot is connected and accepting commands.
+    """
+    if healthy:
+        with open(health_file(), 'w') as file:
+            file.write(str(int(time())))
+    else:
+        try:
+            os.remove(health_file())
+        except FileNotFoundError:
+            pass
+
+
+@tasks.loop(seconds=HEALTH_INTERVAL)
+async def heartbeat():
+    """
+    Refreshes the health check file while the bot is connected, so that a hung event loop shows up as a stale file.
+    """
+    set_healthy(bot.connected and not bot.shutting_down)
+
+
+@bot.check
+async def accepting_commands(ctx):
+    """
+    Global check which refuses any new commands once the bot has begun shutting down.
+    """
+    if bot.shutting_down:
+        raise commands.CheckFailure('The bot is shutting down.')
+    return True
+
+
+@bot.before_invoke
+async def track_command(ctx):
+    bot.inflight.add(asyncio.current_task())
+
+
+@bot.after_invoke
+async def untrack_command(ctx):
+    bot.inflight.discard(asyncio.current_task())
+
+
+async def shutdown(signame):
+    """
+    Gracefully stops the bot: stops accepting commands, waits for in-flight commands (and the replies they send) to
+    finish within the configured deadline, unloads the extensions so they can flush any pending writes, and then
+    disconnects from Discord.
+
+    :param signame: The name of the signal which triggered the shutdown.
+    """
+    if bot.shutting_down:
+        return
+    bot.shutting_down = True
+    set_healthy(False)
+    print(f'Received {signame}, shutting down...')
+
+    # Commands may still start (and be refused with a reply) while draining, so keep waiting until none are left.
+    deadline = bot.loop.time() + bot.config.get('shutdown_timeout', 5)
+    pending = {task for task in bot.inflight if not task.done()}
+    if pending:
+        print(f'Waiting for {len(pending)} command(s) to finish...')
+    while pending and bot.loop.time() < deadline:
+        await asyncio.wait(pending, timeout=deadline - bot.loop.time())
+        pending = {task for task in bot.inflight if not task.done()}
+
+    if pending:
+        for task in pending:
+            task.cancel()
+        # Give the cancelled commands a moment to run their after-invoke hooks and send their replies,
+        # before the extensions listening for them are unloaded.
+        await asyncio.wait(pending, timeout=CANCEL_TIMEOUT)
+        print(f'Cancelled {len(pending)} command(s) which did not finish in time.')
+        bot.exit_status = EXIT_DRAIN_TIMEOUT
+
+    # Unloading an extension calls its cog's `cog_unload`, where pending writes are flushed.
+    for ext in list(bot.extensions):
+        try:
+            bot.unload_extension(ext)
+        except Exception as e:
+            print(f'Failed to unload {ext}: {e}')
+
+    await bot.close()
+
+
+@bot.event
+async def on_message(message):
+    """
+    Replaces the default command processing so that every command goes through the dispatcher's limits.
+
+    :param message: The message that was sent.
+    """
+    if message.author.bot:
+        return
+
+    ctx = await bot.get_context(message)
+    await bot.dispatcher.dispatch(bot, ctx)
+
 
 @bot.event
 async def on_ready():
@@ -110,6 +465,8 @@ async def on_ready():
     # Print connection confirmation
     print(
         f'Logged in as {bot.user} and connected to Discord! (ID: {bot.user.id})')
+    bot.connected = True
+    set_healthy(not bot.shutting_down)
 
     # Set the playing status of the bot to show users how to use the help command.
     await bot.change_presence(activity=discord.Game(name=f'{bot.config["prefix"]}help'))
@@ -121,6 +478,36 @@ async def on_ready():
     """
 
 
+@bot.event
+async def on_resumed():
+    bot.connected = True
+    set_healthy(not bot.shutting_down)
+
+
+@bot.event
+async def on_disconnect():
+    bot.connected = False
+    set_healthy(False)
+
+
+@bot.event
+async def on_command_error(ctx, error):
+    """
+    Prints the errors of commands which don't handle their own errors.
+    This replaces `Bot.on_command_error`, which stops printing as soon as any cog listens for `on_command_error`.
+
+    :param ctx: The context of the command execution.
+    :param error: The error raised by the command.
+    """
+    if hasattr(ctx.command, 'on_error'):
+        return
+    if ctx.cog is not None and type(ctx.cog).cog_command_error is not commands.Cog.cog_command_error:
+        return
+
+    print(f'Ignoring exception in command {ctx.command}:', file=sys.stderr)
+    traceback.print_exception(type(error), error, error.__traceback__, file=sys.stderr)
+
+
 class Internal(commands.Cog, name="Internal"):
     """
     Commands used in the core infrastructure of the bot.
@@ -148,6 +535,31 @@ class Internal(commands.Cog, name="Internal"):
         raise discord.ext.commands.CommandInvokeError(
             'Restart command not implemented.')
 
+    @commands.command(name="running", help="Shows how many of each command are running and queued.")
+    @commands.guild_only()
+    @commands.has_permissions(administrator=True)
+    async def running(self, ctx):
+        """
+        Shows the live number of in-flight and queued invocations of each command that has been used.
+
+        :param ctx: The context of the command execution.
+        """
+        embed = discord.Embed(
+            title="Command Load",
+            timestamp=datetime.datetime.now(datetime.timezone.utc)
+        )
+        for name, slots in sorted(self.bot.dispatcher.slots.items()):
+            embed.add_field(
+                name=name,
+                value=f"In flight: {slots.in_flight}\nQueued: {slots.queued}/{slots.max_queued}",
+                inline=True
+            )
+        embed.set_footer(
+            text=self.bot.config['footer']['text'],
+            icon_url=self.bot.config['footer']['icon_url']
+        )
+        await ctx.send(embed=embed)
+
     @commands.command(name="prefix", help="Changes the command prefix of the bot.", brief="?")
     @commands.guild_only()
     @commands.has_permissions(administrator=True)
@@ -359,6 +771,8 @@ class Internal(commands.Cog, name="Internal"):
         Reloads an extension by the given name.
         NOTE: USE '.' AS A FOLDER PATH SEPARATOR:
         "sample.help" refers to "./cogs/sample/help.py"
+        NOTE: `reload_extension` is synchronous and blocks the event loop, so the dispatcher's timeout cannot
+        interrupt it; it has to modify the bot's cogs and commands, so it can't be moved to an executor either.
 
         :param ctx: The context of the command execution.
         :param cog_name: The name of the cog to be loaded.
@@ -402,10 +816,42 @@ class Internal(commands.Cog, name="Internal"):
 # Register the internal commands cog/
 bot.add_cog(Internal(bot))
 
-# Run the bot with the API token pulled from the environment variable
+# Run the bot with the API token pulled from the environment variable.
+# `bot.run` is not used, as its own signal handling stops the event loop without draining commands.
+loop = bot.loop
+for sig in (signal.SIGTERM, signal.SIGINT):
+    try:
+        loop.add_signal_handler(sig, lambda sig=sig: asyncio.ensure_future(shutdown(sig.name)))
+    except NotImplementedError:
+        # Signal handlers are not supported by the event loop on Windows, SIGINT raises KeyboardInterrupt instead.
+        pass
+
+# A health check file left behind by a killed process must not report this one as healthy before it connects.
+set_healthy(False)
+heartbeat.start()
+
 try:
-    bot.run(bot.config['token'], bot=True, reconnect=True)
+    loop.run_until_complete(bot.start(bot.config['token'], bot=True, reconnect=True))
+except KeyboardInterrupt:
+    loop.run_until_complete(shutdown('SIGINT'))
 except discord.LoginFailure:
+    # Don't wait for input here, it would hang a headless container.
     print(f"Invalid {ENV_TOKEN} variable: {bot.config['token']}")
-    # Send message to Discord if an exception is raised
-    input("Press enter to continue...")
+    bot.exit_status = EXIT_LOGIN_FAILURE
+except discord.PrivilegedIntentsRequired:
+    print(f'The "{chunk_strategy}" chunking strategy requires the Server Members Intent, please enable it for the '
+          f'bot application in the Discord developer portal, or set the chunking strategy to "none".')
+    bot.exit_status = EXIT_PRIVILEGED_INTENTS
+finally:
+    if not bot.is_closed():
+        loop.run_until_complete(bot.close())
+    # Cancel whatever is left running, such as background loops, before closing the event loop.
+    leftover = [task for task in asyncio.all_tasks(loop) if not task.done()]
+    for task in leftover:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*leftover, return_exceptions=True))
+    set_healthy(False)
+    loop.close()
+    logging.shutdown()
+
+sys.exit(bot.exit_status)
@@ -49,6 +49,8 @@ class Botty(commands.Cog, name="Botty McBotface"):
             await ctx.send(f'Please specify a role.')
 
         else:
+            self.bot.request_chunk(ctx.guild)
+
             for each_role in ctx.guild.roles:
                 # case-insensitive roles
                 if role.lower() == each_role.name.lower():
@@ -61,9 +63,12 @@ class Botty(commands.Cog, name="Botty McBotface"):
                     await ctx.send(f'{ctx.author.mention}, successfully added role {role.name}.')
 
                 except discord.Forbidden:
+                    # Errors are replied to rather than raised, so flag the failure for the Stats cog.
+                    ctx.handled_failure = True
                     await ctx.send('Sorry, I do not have sufficient privileges.')
 
                 except Exception as e:
+                    ctx.handled_failure = True
                     await ctx.send(e)
             else:
                 await ctx.send(f'Could not find server role "{role}".')
@@ -87,6 +92,9 @@ class Botty(commands.Cog, name="Botty McBotface"):
             return
 
         else:
+            self.bot.request_chunk(ctx.guild)
+
+            # The author's roles arrive with every message, so this never needs an API call.
             for each_role in ctx.author.roles:
                 # case-insensitive roles
                 if role.lower() == each_role.name.lower():
@@ -99,9 +107,12 @@ class Botty(commands.Cog, name="Botty McBotface"):
                     await ctx.send(f'{ctx.author.mention}, successfully removed role {role.name}.')
 
                 except discord.Forbidden:
+                    # Errors are replied to rather than raised, so flag the failure for the Stats cog.
+                    ctx.handled_failure = True
                     await ctx.send('Sorry, I do not have sufficient privileges.')
 
                 except Exception as e:
+                    ctx.handled_failure = True
                     await ctx.send(e)
             else:
                 await ctx.send(f'Could not find user role "{role}".')
@@ -0,0 +1,277 @@
+import datetime
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import Counter, deque
+from time import time
+
+import discord
+from discord.ext import commands, tasks
+
+"""
+*******************************************************************************
+This is a Cog. These structures are used by Discord.py to create classes
+with their own commands, event listeners, and attributes.
+
+Command usage analytics: counts command completions, failures, and the roles
+requested through `addrole` per guild. Counts are kept in memory in per-minute
+buckets and are rolled up into hourly and daily totals in a local JSON store
+by a background task, so no disk I/O happens while a command is running.
+
+Authors: Joe Miller (@thatnerdjoe)
+Version: 0.1
+Date: 10-19-2026
+*******************************************************************************
+"""
+
+# Default location of the rolled up statistics, relative to the bot's directory.
+STATS_FILE = './stats.json'
+
+# How many hourly rollups are kept in the store before being discarded.
+# Daily rollups are kept indefinitely.
+HOURLY_RETENTION = 48
+
+
+def new_bucket():
+    """
+    Creates an empty set of counters for a single guild.
+
+    :return: A dict of Counters keyed by the kind of event being counted.
+    """
+    return {
+        'commands': Counter(),
+        'failures': Counter(),
+        'roles': Counter()
+    }
+
+
+def merge_bucket(target, source):
+    """
+    Adds the counts of one guild bucket into another.
+
+    :param target: The bucket (dict of Counters or plain dicts) to add into.
+    :param source: The bucket whose counts are being added.
+    """
+    for key, counts in source.items():
+        totals = target.setdefault(key, {})
+        for name, count in counts.items():
+            totals[name] = totals.get(name, 0) + count
+
+
+class Stats(commands.Cog, name="Stats"):
+    """
+    Commands used to view how the bot is being used in this server.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.stats_file = os.path.abspath(
+            bot.config.get('stats', {}).get('file', STATS_FILE))
+
+        # Closed and open per-minute buckets: (minute, {guild_id: bucket}).
+        # Drained on every rollup, so at most one rollup period of minutes is held.
+        self.minutes = deque()
+        self.store = self.load_store()
+
+        # Each snapshot of the store is numbered, so that an older snapshot still being written by the rollup task
+        # can never replace a newer one written by `cog_unload`.
+        self.version = 0
+        self.written = 0
+        self.write_lock = threading.Lock()
+
+        self.rollup.start()
+        print("Loaded Stats Cog.")
+
+    def cog_unload(self):
+        self.rollup.cancel()
+        # Flush anything that has not been rolled up yet.
+        self.write_store(*self.collect(flush_all=True))
+        print("Unloaded Stats Cog.")
+
+    def load_store(self):
+        """
+        Reads the rolled up statistics from the stats file, if one exists.
+        An unreadable file is moved aside rather than overwritten, so its history can still be recovered.
+
+        :return: The store, with "hourly" and "daily" rollups keyed by period.
+        """
+        try:
+            with open(self.stats_file, 'r') as file:
+                store = json.load(file)
+        except FileNotFoundError:
+            store = {}
+        except json.JSONDecodeError as e:
+            os.replace(self.stats_file, self.stats_file + '.corrupt')
+            print(f'Could not read stats file "{self.stats_file}", moved it to "{self.stats_file}.corrupt": {e}')
+            store = {}
+        store.setdefault('hourly', {})
+        store.setdefault('daily', {})
+        return store
+
+    def write_store(self, version, store):
+        """
+        Atomically replaces the stats file with a snapshot of the store. Runs outside of the event loop.
+
+        :param version: The number of the snapshot, as returned by `collect`.
+        :param store: The snapshot to be written.
+        """
+        with self.write_lock:
+            if version <= self.written:
+                return
+
+            directory = os.path.dirname(self.stats_file)
+            fd, temp_file = tempfile.mkstemp(dir=directory, prefix='.stats-', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as file:
+                    file.write(json.dumps(store, indent=2))
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_file, self.stats_file)
+            except BaseException:
+                os.remove(temp_file)
+                raise
+            self.written = version
+
+    def bucket(self, guild):
+        """
+        Returns the bucket counting the current minute for a guild.
+
+        :param guild: The guild the event happened in.
+        :return: The guild's bucket for the current minute.
+        """
+        minute = int(time() // 60)
+        if not self.minutes or self.minutes[-1][0] != minute:
+            self.minutes.append((minute, {}))
+        return self.minutes[-1][1].setdefault(str(guild.id), new_bucket())
+
+    def collect(self, flush_all=False):
+        """
+        Folds closed minute buckets into the hourly and daily rollups.
+
+        :param flush_all: Also fold in the minute that is still being counted.
+        :return: The snapshot's number and a snapshot of the store, safe to write from another thread.
+        """
+        current = int(time() // 60)
+        while self.minutes and (flush_all or self.minutes[0][0] < current):
+            minute, guilds = self.minutes.popleft()
+            stamp = datetime.datetime.fromtimestamp(minute * 60, datetime.timezone.utc)
+            hour = self.store['hourly'].setdefault(stamp.strftime('%Y-%m-%dT%H'), {})
+            day = self.store['daily'].setdefault(stamp.strftime('%Y-%m-%d'), {})
+            for guild_id, bucket in guilds.items():
+                merge_bucket(hour.setdefault(guild_id, {}), bucket)
+                merge_bucket(day.setdefault(guild_id, {}), bucket)
+
+        # Hourly keys sort chronologically, so the oldest are dropped first.
+        for hour in sorted(self.store['hourly'])[:-HOURLY_RETENTION]:
+            del self.store['hourly'][hour]
+
+        self.version += 1
+        return self.version, json.loads(json.dumps(self.store))
+
+    @tasks.loop(hours=1)
+    async def rollup(self):
+        """
+        Periodically rolls the in-memory counts up into the stats file.
+        """
+        # Errors are caught here, as an error escaping the loop would stop it for good, leaving the minute buckets
+        # to grow without ever being rolled up. The counts stay in the store and are written on the next rollup.
+        try:
+            version, snapshot = self.collect()
+            await self.bot.loop.run_in_executor(None, self.write_store, version, snapshot)
+        except Exception as e:
+            print(f'Failed to write stats file "{self.stats_file}": {e}', file=sys.stderr)
+
+    def guild_totals(self, guild):
+        """
+        Totals every count recorded for a guild, including those not yet rolled up.
+
+        :param guild: The guild to total the counts for.
+        :return: A bucket of Counters holding the guild's totals.
+        """
+        totals = new_bucket()
+        guild_id = str(guild.id)
+        for day in self.store['daily'].values():
+            merge_bucket(totals, day.get(guild_id, {}))
+        for _, guilds in self.minutes:
+            merge_bucket(totals, guilds.get(guild_id, {}))
+        return totals
+
+    @commands.Cog.listener()
+    async def on_command_completion(self, ctx):
+        # Commands cancelled by the dispatcher still complete, but are counted through their CommandTimedOut error.
+        if ctx.guild is None or ctx.command_failed:
+            return
+
+        bucket = self.bucket(ctx.guild)
+        # Commands which reply with an error instead of raising one set `ctx.handled_failure`.
+        if getattr(ctx, 'handled_failure', False):
+            bucket['failures'][ctx.command.qualified_name] += 1
+        else:
+            bucket['commands'][ctx.command.qualified_name] += 1
+
+        # Only count roles that exist, so free-form input can't grow the counters.
+        if ctx.command.qualified_name == 'addrole' and ctx.kwargs.get('role'):
+            requested = str(ctx.kwargs['role']).lower()
+            role = discord.utils.find(lambda r: r.name.lower() == requested, ctx.guild.roles)
+            if role is not None:
+                bucket['roles'][role.name] += 1
+
+    @commands.Cog.listener()
+    async def on_command_error(self, ctx, error):
+        # Unknown commands are ignored, as their names are arbitrary user input.
+        if ctx.guild is None or ctx.command is None:
+            return
+
+        self.bucket(ctx.guild)['failures'][ctx.command.qualified_name] += 1
+
+    @commands.command(name="stats", help="Shows how the bot's commands are used in this server.")
+    @commands.guild_only()
+    async def stats(self, ctx):
+        """
+        Shows the most used commands, the most requested roles, and command failure rates for the guild.
+
+        :param ctx: The context of the command execution.
+        """
+        totals = self.guild_totals(ctx.guild)
+        commands_used = Counter(totals['commands'])
+        failures = Counter(totals['failures'])
+        roles = Counter(totals['roles'])
+
+        embed = discord.Embed(
+            title=f"{ctx.guild.name} Command Usage",
+            timestamp=datetime.datetime.now(datetime.timezone.utc)
+        )
+        embed.add_field(
+            name="Top Commands",
+            value="\n".join(f"`{name}` - {count}" for name, count in commands_used.most_common(5)) or "None",
+            inline=True
+        )
+        embed.add_field(
+            name="Top Requested Roles",
+            value="\n".join(f"{name} - {count}" for name, count in roles.most_common(5)) or "None",
+            inline=True
+        )
+
+        failure_rates = []
+        for name, count in failures.most_common(5):
+            runs = commands_used[name] + count
+            failure_rates.append(f"`{name}` - {count}/{runs} ({count / runs:.0%})")
+        embed.add_field(
+            name="Failure Rates",
+            value="\n".join(failure_rates) or "None",
+            inline=False
+        )
+        embed.set_footer(
+            text=self.bot.config['footer']['text'],
+            icon_url=self.bot.config['footer']['icon_url']
+        )
+        await ctx.send(embed=embed)
+
+
+def setup(bot):
+    """
+    Required by Discord.py for extensible, multi-file projects typically used with Cogs.
+    """
+    bot.add_cog(Stats(bot))